@@ -33,6 +33,7 @@ create table blogs(
     `summary` varchar(200) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=InnoDB default charset=utf8;
@@ -43,10 +44,11 @@ create table comments(
     `blog_id` varchar(50) not null,
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
-    `user_image` varchar(50) not null,
+    `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
 ) engine=InnoDB default charset=utf8;
 
@@ -46,14 +46,21 @@ awesome-home
 
 
 import logging; logging.basicConfig(level=logging.INFO)
-import asyncio, os, json, time
+import asyncio, os, time, hashlib, gzip
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from datetime import datetime
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from urllib import parse
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, BytecodeCache, FileSystemBytecodeCache
 
-import orm
-from coroweb import add_routes, add_static
+import orm, jsonenc
+from assets import accept_encodings, brotli
+from config import configs
+from coroweb import add_routes, add_routes_from_manifest, add_static, read_body
 
 
 '''
@@ -67,15 +74,52 @@ add_routes(app, 'handlers')
 add_static(app)
 '''
 
+# 进程内的bytecode cache：同一个进程里重新加载模板(例如超出cache_size被淘汰)时不用重新编译
+class MemoryBytecodeCache(BytecodeCache):
+    def __init__(self):
+        self._data = dict()
+
+    def load_bytecode(self, bucket):
+        code = self._data.get(bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        self._data[bucket.key] = bucket.bytecode_to_string()
+
+    def clear(self):
+        self._data.clear()
+
+def _bytecode_cache(option):
+    # None：不用；'memory'：进程内；'filesystem'：系统临时目录；其他字符串：缓存目录；也可以直接传BytecodeCache对象
+    if option is None or isinstance(option, BytecodeCache):
+        return option
+    if option == 'memory':
+        return MemoryBytecodeCache()
+    if option == 'filesystem':
+        return FileSystemBytecodeCache()
+    os.makedirs(option, exist_ok=True)
+    return FileSystemBytecodeCache(option)
+
 def init_jinja2(app, **kw):
+    '''
+    production=True时：auto_reload默认关闭(渲染时不再stat模板文件)，bytecode_cache默认'filesystem'，
+    启动时编译所有模板(precompile)，编译结果不再被淘汰(cache_size=-1)。
+    stream=True时使用async模式，模板用render_async渲染，处理函数返回的dict里有'__stream__': True时分块(chunked)发送。
+    '''
     logging.info('init jinja2...')
+    production = kw.get('production', False)
+    stream = kw.get('stream', False)
     options = dict(
         autoescape = kw.get('autoescape', True),
         block_start_string = kw.get('block_start_string', '{%'),
         block_end_string = kw.get('block_end_string', '%}'),
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
-        auto_reload = kw.get('auto_reload', True)           
+        auto_reload = kw.get('auto_reload', not production),
+        bytecode_cache = _bytecode_cache(kw.get('bytecode_cache', 'filesystem' if production else None)),
+        cache_size = kw.get('cache_size', -1 if production else 400),
+        enable_async = stream
     )
     path = kw.get('path', None)
     if path is None:
@@ -86,6 +130,13 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    env.globals.update(kw.get('globals', None) or {})
+    if kw.get('precompile', production):
+        # 启动时编译所有模板，模板有语法错误时启动就失败，而不是等到第一次请求
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)
+        logging.info('precompiled %s templates' % len(names))
     app['__templating__'] = env
     
 
@@ -102,19 +153,309 @@ async def logger_factory(app, handler):
         return (await handler(request))
     return logger
 
+# 每个请求使用独立的identity map，同一个请求里重复find同一个主键只查一次，并且返回同一个实例
+async def identity_map_factory(app, handler):
+    async def identity_map(request):
+        with orm.identity_map():
+            return (await handler(request))
+    return identity_map
+
+# 提前解析POST正文(按路由的max_body限制大小)，结果缓存在request里，RequestHandler不会再解析一次
 async def data_factory(app, handler):
     async def parse_data(request):
-        if request.method == 'POST':
-            if request.content_type.startswith('application/json'):
-                request.__data__ = await request.json()
-                logging.info('request json: %s' % str(request.__data__))
-            elif request.content_type.startswith('application/x-www-form-urlencoded'):
-                request.__data__ = await request.post()
-                logging.info('request form: %s ' % str(request.__data__))
+        if request.method == 'POST' and request.content_type:
+            try:
+                request.__data__, multi = await read_body(request, getattr(route_handler(request), 'max_body', None))
+            except web.HTTPException as e:
+                return e
+            logging.debug('request data: %s' % str(request.__data__))
         return (await handler(request))
     return parse_data
 
 
+'''
+条件GET：@get(path, etag=..., max_age=...)的路由加上ETag/Last-Modified/Cache-Control，
+请求带If-None-Match/If-Modified-Since并且没有变化时返回304。
+etag=True时要先执行处理函数、渲染出正文再计算ETag，只省掉传输；
+etag是版本号函数时在执行处理函数之前就能判断，不用查库、不用渲染模板。
+'''
+def _etag_matches(header, tag):
+    # If-None-Match用弱比较：忽略W/前缀
+    for t in header.split(','):
+        t = t.strip()
+        if t == '*' or (t[2:] if t.startswith('W/') else t) == tag:
+            return True
+    return False
+
+def _not_modified(request, tag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # 有If-None-Match时忽略If-Modified-Since
+        return tag is not None and _etag_matches(if_none_match, tag)
+    since = request.headers.get('If-Modified-Since')
+    if since is None or last_modified is None:
+        return False
+    t = parsedate_tz(since)
+    return t is not None and int(last_modified) <= mktime_tz(t)
+
+def _cache_headers(tag, last_modified, max_age):
+    headers = dict()
+    if tag is not None:
+        headers['ETag'] = tag
+    if last_modified is not None:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    if max_age is not None:
+        headers['Cache-Control'] = 'max-age=%d' % max_age
+    return headers
+
+def route_handler(request):
+    ' 路由注册的处理器对象(RequestHandler/LazyRequestHandler) '
+    # aiohttp 3.x把不是协程函数的handler包成一个函数再注册，包装函数只复制了实例的__dict__，
+    # 没有version等方法，要用__wrapped__取回原来的对象
+    h = request.match_info.handler
+    return getattr(h, '__wrapped__', h)
+
+async def conditional_factory(app, handler):
+    async def conditional(request):
+        route = route_handler(request)
+        etag = getattr(route, 'etag', None)
+        max_age = getattr(route, 'max_age', None)
+        if request.method not in ('GET', 'HEAD') or (not etag and max_age is None):
+            return (await handler(request))
+        tag = last_modified = None
+        if etag and etag is not True:
+            version = await route.version(request)
+            # 版本号加上路径和query string，不同的页面不会得到相同的ETag
+            tag = '"%s"' % hashlib.sha1(('%s\n%r' % (request.path_qs, version)).encode('utf-8')).hexdigest()
+            if isinstance(version, (int, float)) and not isinstance(version, bool):
+                last_modified = version
+            if _not_modified(request, tag, last_modified):
+                return web.HTTPNotModified(headers=_cache_headers(tag, last_modified, max_age))
+        r = await handler(request)
+        if not isinstance(r, web.Response) or r.status != 200 or not isinstance(r.body, bytes):
+            return r
+        if etag is True:
+            tag = '"%s"' % hashlib.sha1(r.body).hexdigest()
+            if _not_modified(request, tag, None):
+                return web.HTTPNotModified(headers=_cache_headers(tag, None, max_age))
+        elif tag is not None and 'Content-Encoding' in r.headers:
+            # 版本号ETag不区分压缩方式，压缩过的正文用弱ETag(If-None-Match是弱比较，304照样有效)
+            tag = 'W/' + tag
+        r.headers.update(_cache_headers(tag, last_modified, max_age))
+        return r
+    return conditional
+
+
+'''
+服务端响应缓存：@get(path, cache_ttl=..., cache_tags=...)的路由，GET请求的响应按(路径, 排序后的query string)缓存在内存里，
+按条目数和总字节数LRU淘汰。ORM写入cache_tags里的Model时(orm.add_write_listener)清掉对应的响应。
+同一个key同时有多个请求未命中时，只有第一个请求执行处理函数，其他请求等它的结果(single-flight)。
+只缓存200并且没有Set-Cookie的响应；缓存的页面对所有用户都一样，依赖当前用户的页面不要加cache_ttl。
+'''
+class ResponseCache(object):
+    def __init__(self, max_entries=1000, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (过期时间, status, headers, body, tags)
+        self._tags = dict()         # tag -> set(key)
+        # 每个tag清缓存时加1：请求处理期间它依赖的tag有写入时，不缓存它的响应(可能是旧数据)，其他表的写入不影响
+        self._generations = dict()  # tag -> 次数
+        self._cleared = 0           # clear()的次数
+        self.inflight = dict()      # key -> future，正在生成的响应
+
+    def generation(self, tags):
+        return (self._cleared,) + tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._pop(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key, ttl, status, headers, body, tags, generation):
+        ' 缓存一个响应，返回缓存的条目；生成期间tags有写入或者响应太大时不缓存，返回None '
+        # 太大的响应不缓存，免得挤掉其他所有条目
+        if generation != self.generation(tags) or len(body) > self.max_bytes // 10:
+            return None
+        self._pop(key)
+        entry = self._data[key] = (time.monotonic() + ttl, status, headers, body, tags)
+        self.size += len(body)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.max_entries or self.size > self.max_bytes:
+            self._pop(next(iter(self._data)))
+        return entry
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[3])
+            for tag in entry[4]:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+    def invalidate(self, tag):
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+        for key in list(self._tags.get(tag, ())):
+            self._pop(key)
+
+    def invalidate_model(self, model):
+        self.invalidate(model.__table__)
+
+    def clear(self):
+        self._cleared += 1
+        self._data.clear()
+        self._tags.clear()
+        self.size = 0
+
+    def stats(self):
+        return dict(entries=len(self._data), bytes=self.size, hits=self.hits, misses=self.misses)
+
+def _cache_key(request):
+    # query string的参数排序，?a=1&b=2和?b=2&a=1用同一个缓存
+    # compression_factory在缓存里面，缓存的是压缩后的正文，所以key里还要加上协商出来的压缩方式(Vary: Accept-Encoding)
+    return '%s?%s#%s' % (request.path, parse.urlencode(sorted(request.query.items())),
+                         _choose_encoding(request.headers.get('Accept-Encoding')) or 'identity')
+
+async def response_cache_factory(app, handler):
+    async def response_cache(request):
+        route = route_handler(request)
+        ttl = getattr(route, 'cache_ttl', None)
+        cache = app.get('__response_cache__')
+        if request.method != 'GET' or not ttl or cache is None:
+            return (await handler(request))
+        key = _cache_key(request)
+        entry = cache.get(key)
+        if entry is not None:
+            return _cached_response(entry)
+        fut = cache.inflight.get(key)
+        if fut is not None:
+            # 已经有请求在生成这个响应，等它的结果；它没能缓存(例如不是200)时自己执行
+            entry = await asyncio.shield(fut)
+            if entry is not None:
+                return _cached_response(entry)
+            return (await handler(request))
+        fut = cache.inflight[key] = asyncio.get_event_loop().create_future()
+        entry = None
+        try:
+            generation = cache.generation(route.cache_tags)
+            r = await handler(request)
+            if isinstance(r, web.Response) and r.status == 200 and isinstance(r.body, bytes) and not r.cookies:
+                headers = dict((k, v) for k, v in r.headers.items() if k.lower() != 'content-length')
+                entry = cache.set(key, ttl, r.status, headers, r.body, route.cache_tags, generation)
+            return r
+        finally:
+            del cache.inflight[key]
+            fut.set_result(entry)
+    return response_cache
+
+def _cached_response(entry):
+    expires, status, headers, body, tags = entry
+    return web.Response(status=status, headers=headers, body=body)
+
+def init_response_cache(app, **kw):
+    cache = ResponseCache(**kw)
+    app['__response_cache__'] = cache
+    orm.add_write_listener(cache.invalidate_model)
+    return cache
+
+
+'''
+动态压缩：response_factory生成的响应按Accept-Encoding压缩(br优先，没装brotli时只用gzip)。
+只压缩COMPRESS_POLICY里的类型，并且正文不小于COMPRESS_MIN_SIZE；
+正文超过COMPRESS_THREAD_SIZE时放到单独的线程池里压缩，不阻塞事件循环，也不占用默认的executor。
+静态文件(FileResponse)和流式响应不经过这里，静态文件的压缩版本见assets.py。
+这个middleware放在response_cache_factory里面：缓存命中时直接返回压缩好的正文，不用每次重新压缩；
+也在conditional_factory里面：etag=True时ETag按压缩后的正文计算，每种压缩方式的ETag不同。
+'''
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_THREAD_SIZE = 64 * 1024
+# content type -> (gzip level, brotli quality)，动态压缩用中等级别，压缩比和CPU之间折中
+COMPRESS_POLICY = {
+    'text/html': (6, 5),
+    'text/plain': (6, 5),
+    'text/css': (6, 5),
+    'text/xml': (6, 5),
+    'application/json': (6, 5),
+    'application/javascript': (6, 5),
+    'image/svg+xml': (6, 5)
+}
+_compress_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='compress')
+
+def _choose_encoding(header):
+    accepted = accept_encodings(header)
+    best = None
+    for encoding in (('br', 'gzip') if brotli is not None else ('gzip',)):
+        q = accepted.get(encoding, accepted.get('*', 0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (encoding, q)
+    return best and best[0]
+
+def _compress(body, encoding, levels):
+    if encoding == 'br':
+        return brotli.compress(body, quality=levels[1])
+    return gzip.compress(body, levels[0], mtime=0)
+
+async def compression_factory(app, handler):
+    async def compression(request):
+        r = await handler(request)
+        if not isinstance(r, web.Response) or r.status != 200 or not isinstance(r.body, bytes):
+            return r
+        levels = COMPRESS_POLICY.get(r.content_type)
+        if levels is None or len(r.body) < COMPRESS_MIN_SIZE or 'Content-Encoding' in r.headers \
+                or 'no-transform' in r.headers.get('Cache-Control', ''):
+            return r
+        vary = r.headers.get('Vary')
+        r.headers['Vary'] = 'Accept-Encoding' if not vary else vary + ', Accept-Encoding'
+        encoding = _choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return r
+        if len(r.body) > COMPRESS_THREAD_SIZE:
+            body = await asyncio.get_event_loop().run_in_executor(_compress_executor, _compress, r.body, encoding, levels)
+        else:
+            body = _compress(r.body, encoding, levels)
+        r.body = body
+        r.headers['Content-Encoding'] = encoding
+        return r
+    return compression
+
+
+# 模板边渲染边发送(chunked)，不用等整个页面渲染完，长页面的首字节时间更短
+# 凑够STREAM_CHUNK_SIZE再write，避免每个很小的片段都发一次
+# 注意：流式响应没有完整的正文，不会加ETag，也不会进服务端响应缓存
+STREAM_CHUNK_SIZE = 16 * 1024
+
+async def stream_template(request, template, context):
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    buf = []
+    size = 0
+    async for s in template.generate_async(**context):
+        buf.append(s)
+        size += len(s)
+        if size >= STREAM_CHUNK_SIZE:
+            await resp.write(''.join(buf).encode('utf-8'))
+            buf = []
+            size = 0
+    if buf:
+        await resp.write(''.join(buf).encode('utf-8'))
+    await resp.write_eof()
+    return resp
+
 async def response_factory(app, handler):
     async def response(request):
         logging.info('Response handler...')
@@ -134,13 +475,18 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=jsonenc.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
+            env = app['__templating__']
+            if not env.is_async:
+                resp = web.Response(body=env.get_template(template).render(**r).encode('utf-8'))
+            elif r.get('__stream__'):
+                return (await stream_template(request, env.get_template(template), r))
             else:
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset=utf-8'
-                return resp
+                resp = web.Response(body=(await env.get_template(template).render_async(**r)).encode('utf-8'))
+            resp.content_type = 'text/html;charset=utf-8'
+            return resp
         if isinstance(r, int) and r>=100 and r<600:
             return web.Response(r)
         if isinstance(r, tuple) and len(r)==2:
@@ -178,17 +524,21 @@ def datetime_filter(t):
 
 async def init(loop):
     await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='www-data', password='www-data', db='awesome')
-    app = web.Application(loop=loop, middlewares=[logger_factory, response_factory])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
-    add_routes(app, 'handlers') #将’handlers‘模块中的URL处理函数注册到app路由中
-    add_static(app)
+    app = web.Application(loop=loop, middlewares=[logger_factory, identity_map_factory, conditional_factory, response_cache_factory, compression_factory, response_factory])
+    init_response_cache(app)
+    static = add_static(app)
+    init_jinja2(app, filters=dict(datetime=datetime_filter), globals=dict(static_url=static.url), **configs.jinja2)
+    #有路由清单(python coroweb.py handlers生成)时按清单注册，处理函数第一次请求时才import；否则扫描handlers模块
+    if not add_routes_from_manifest(app, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes.json')):
+        add_routes(app, 'handlers') #将’handlers‘模块中的URL处理函数注册到app路由中
     srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
 
 
 
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Nov  2 15:08:52 2018
+
+@author: keen_liu
+"""
+
+
+'''
+静态文件
+
+原来add_static只是router.add_static('/static/', path)：css/js不压缩，也没有长期缓存的响应头。
+现在启动时(或者部署时 python assets.py)先处理一遍static目录：
+
+1. 每个文件按内容计算hash，生成带hash的URL：css/uikit.min.css => /static/css/uikit.min.1a2b3c4d5e.css
+   模板里用 {{ static_url('css/uikit.min.css') }}，文件内容变了URL就变了，所以可以 Cache-Control: immutable
+2. css/js/字体等可以压缩的文件预先生成gzip和brotli(装了brotli时)版本，放在static_build目录下，
+   文件名里带hash，内容没变时下次启动直接复用
+   清单写在static_build/assets.json，下次启动时修改时间和大小都没变的文件不再重新计算hash
+3. 请求按Accept-Encoding选择br/gzip/原文件，用web.FileResponse发送(sendfile，不经过python复制)
+
+不带hash的旧URL(/static/css/uikit.min.css，以及css里相对路径引用的字体)仍然可以访问，只是缓存时间短(STATIC_MAX_AGE)。
+'''
+
+import os, json, gzip, hashlib, logging, mimetypes
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# 可以压缩的文件类型，图片和woff本身已经压缩过了
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.html', '.txt', '.json', '.xml', '.ttf', '.otf', '.eot')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+STATIC_MAX_AGE = 3600
+
+def accept_encodings(header):
+    ' 解析Accept-Encoding，返回{编码: q} '
+    codings = dict()
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for p in parts[1:]:
+            k, _, v = p.strip().partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+def hashed_name(name, digest):
+    ' css/uikit.min.css => css/uikit.min.<digest>.css '
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, digest, ext)
+
+def _file_hash(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()[:10]
+
+def _compress(path, out, encoding):
+    # 压缩过的文件已经存在(文件名带hash，内容相同)时直接复用
+    if not os.path.isfile(out):
+        with open(path, 'rb') as f:
+            data = f.read()
+        data = gzip.compress(data, 9) if encoding == 'gzip' else brotli.compress(data, quality=11)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        tmp = out + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, out)
+    return os.path.getsize(out)
+
+def _load_manifest(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def _reusable(asset, st, encodings):
+    # 修改时间、大小和尝试过的压缩方式都没变，并且压缩文件还在
+    if asset is None or asset.get('mtime') != st.st_mtime or asset.get('size') != st.st_size or asset.get('encodings') != encodings:
+        return False
+    return all(asset[e] is None or os.path.isfile(asset[e]) for e in encodings)
+
+def build_assets(static_dir, build_dir):
+    '''
+    处理static目录，返回清单{逻辑名: dict(hashed, size, mtime, encodings, gzip, br)}，
+    gzip/br是压缩文件的路径(比原文件小10%以上才用)，encodings是尝试过的压缩方式。
+    清单同时写到build_dir/assets.json，下次调用时没有变化的文件直接用清单里的结果。
+    '''
+    manifest = os.path.join(build_dir, 'assets.json')
+    previous = _load_manifest(manifest)
+    assets = dict()
+    built = 0
+    for root, dirs, files in os.walk(static_dir):
+        for fname in files:
+            path = os.path.join(root, fname)
+            name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            st = os.stat(path)
+            encodings = []
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                encodings = ['gzip', 'br'] if brotli is not None else ['gzip']
+            if _reusable(previous.get(name), st, encodings):
+                assets[name] = previous[name]
+                continue
+            built += 1
+            asset = dict(hashed=hashed_name(name, _file_hash(path)), size=st.st_size, mtime=st.st_mtime,
+                         encodings=encodings, gzip=None, br=None)
+            for encoding in encodings:
+                out = os.path.join(build_dir, asset['hashed'] + ('.gz' if encoding == 'gzip' else '.br'))
+                if _compress(path, out, encoding) < st.st_size * 0.9:
+                    asset[encoding] = out
+            assets[name] = asset
+    if built or assets != previous:
+        os.makedirs(build_dir, exist_ok=True)
+        with open(manifest, 'w', encoding='utf-8') as f:
+            json.dump(assets, f, indent=1)
+    logging.info('build %s static assets (%s changed) => %s' % (len(assets), built, build_dir))
+    return assets
+
+
+class StaticHandler(object):
+    ' /static/{path}的处理器：带hash的URL加immutable，按Accept-Encoding选择预先压缩的文件 '
+    def __init__(self, prefix, static_dir, assets):
+        self.prefix = prefix
+        self.static_dir = static_dir
+        self.assets = assets
+        self._hashed = dict((a['hashed'], name) for name, a in assets.items())
+
+    def url(self, name):
+        ' 模板里的static_url(name)：返回带hash的URL，不在清单里的文件返回原URL '
+        asset = self.assets.get(name)
+        if asset is None:
+            logging.warning('static asset not found: %s' % name)
+            return self.prefix + name
+        return self.prefix + asset['hashed']
+
+    async def __call__(self, request):
+        path = request.match_info['path']
+        name = self._hashed.get(path)
+        immutable = name is not None
+        if name is None:
+            name = path
+        asset = self.assets.get(name)
+        if asset is None:
+            raise web.HTTPNotFound()
+        filename = os.path.join(self.static_dir, *name.split('/'))
+        ct = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        headers = {'Content-Type': ct, 'Cache-Control': IMMUTABLE if immutable else 'max-age=%d' % STATIC_MAX_AGE}
+        if asset['gzip'] or asset['br']:
+            headers['Vary'] = 'Accept-Encoding'
+            accepted = accept_encodings(request.headers.get('Accept-Encoding'))
+            for encoding in ('br', 'gzip'):
+                if asset[encoding] and accepted.get(encoding, 0) > 0:
+                    filename = asset[encoding]
+                    headers['Content-Encoding'] = encoding
+                    break
+        return web.FileResponse(filename, headers=headers)
+
+def add_assets(app, static_dir, build_dir, prefix='/static/'):
+    ' 处理static目录并注册/static/路由，返回StaticHandler(url()用作模板的static_url) '
+    handler = StaticHandler(prefix, static_dir, build_assets(static_dir, build_dir))
+    app.router.add_route('GET', prefix + '{path:.*}', handler)
+    app['__assets__'] = handler
+    logging.info('add static %s => %s' % (prefix, static_dir))
+    return handler
+
+
+if __name__ == '__main__':
+    # 部署时预先生成压缩文件：python assets.py
+    logging.basicConfig(level=logging.INFO)
+    here = os.path.dirname(os.path.abspath(__file__))
+    build_assets(os.path.join(here, 'static'), os.path.join(here, 'static_build'))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Nov  5 10:21:44 2018
+
+@author: keen_liu
+"""
+
+
+'''
+ORM冒烟测试和性能回归
+
+在SQLite(:memory:)上跑一遍ORM的主要功能，检查结果，并打印每一步的耗时，不需要MySQL，CI上直接运行：
+
+python bench_orm.py             默认1000条blog
+python bench_orm.py 10000
+
+任何一步结果不对时以非0退出。
+'''
+
+import asyncio, logging, sys, time
+
+import orm, schema
+from models import User, Blog, Comment, next_id
+
+
+class Bench(object):
+    def __init__(self):
+        self.results = []
+
+    def step(self, name, n=1):
+        return _Step(self, name, n)
+
+    def report(self):
+        for name, n, t in self.results:
+            print('%-28s %8d ops %9.2f ms %10.0f ops/s' % (name, n, t * 1000, n / t if t else 0))
+
+class _Step(object):
+    def __init__(self, bench, name, n):
+        self.bench = bench
+        self.name = name
+        self.n = n
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.bench.results.append((self.name, self.n, time.perf_counter() - self.start))
+
+
+def new_blog(user, i):
+    return Blog(id=next_id(), user_id=user.id, user_name=user.name, user_image=user.image,
+                name='blog %s' % i, summary='summary %s' % i, content='content %s' % i, created_at=1500000000.0 + i)
+
+async def run(n):
+    n = max(n, 300)   # update/transaction/remove各用掉100条blog
+    bench = Bench()
+    await orm.create_pool(None, driver='sqlite', db=':memory:')
+    await schema.create_tables([User, Blog, Comment])
+    assert await schema.diff_schema([User, Blog, Comment]) == []
+
+    user = User(id=next_id(), email='test@example.com', passwd='x', name='test', image='about:blank')
+    await user.save()
+
+    blogs = [new_blog(user, i) for i in range(n)]
+    with bench.step('save_many', n):
+        assert await Blog.save_many(blogs) == n
+    with bench.step('save', 100):
+        for i in range(n, n + 100):
+            await new_blog(user, i).save()
+    n += 100
+    assert await Blog.findNumber('count(id)') == n
+
+    with bench.step('find', 100):
+        for b in blogs[:100]:
+            assert (await Blog.find(b.id)).name == b.name
+    with bench.step('find_many', 1):
+        assert [b.id for b in await Blog.find_many([b.id for b in blogs[:100]])] == [b.id for b in blogs[:100]]
+    with bench.step('load (batched)', 100):
+        found = await asyncio.gather(*[Blog.load(b.id) for b in blogs[:100]])
+        assert [b.id for b in found] == [b.id for b in blogs[:100]]
+
+    with bench.step('findAll', 1):
+        assert len(await Blog.findAll(where='user_id=?', args=[user.id])) == n
+    with bench.step('findAll compact', 1):
+        rows = await Blog.findAll(orderBy='created_at desc', compact=True)
+        assert len(rows) == n and rows[0].name == 'blog %s' % (n - 1)
+    with bench.step('findPage (all pages)', 1):
+        pages = 0
+        after = None
+        seen = 0
+        while True:
+            page, after = await Blog.findPage(after=after, limit=50)
+            seen += len(page)
+            pages += 1
+            if after is None:
+                break
+        assert seen == n
+    with bench.step('iter_all', 1):
+        assert len([b async for b in Blog.iter_all(batch_size=200)]) == n
+
+    with bench.step('update', 100):
+        for b in blogs[:100]:
+            b.name = 'updated'
+            await b.update()
+    assert (await Blog.find(blogs[0].id)).name == 'updated'
+    with bench.step('transaction', 1):
+        async with orm.transaction():
+            for b in blogs[100:200]:
+                await b.remove()
+    with bench.step('remove', 100):
+        for b in blogs[200:300]:
+            await b.remove()
+    assert await Blog.findNumber('count(id)') == n - 200
+
+    await orm.destroy_pool()
+    bench.report()
+
+
+if __name__ == '__main__':
+    # orm/models导入时设置了INFO(会打印每条sql)，跑分时只打印警告
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Nov  5 15:02:37 2018
+
+@author: keen_liu
+"""
+
+
+'''
+Web层冒烟测试和性能回归
+
+用aiohttp.test_utils在本机起一个app(和app.init一样的middleware)，数据库用SQLite(:memory:)，不需要MySQL：
+1. 通过add_route和路由清单注册路由，检查条件GET：etag是版本号函数的路由，版本号没变时不执行处理函数直接返回304
+2. 并发请求模板页面、JSON接口、服务端缓存的接口，打印每秒请求数和延迟(p50/p99)
+
+python bench_web.py             默认每个接口1000个请求，并发20
+python bench_web.py 5000 50
+
+任何一步结果不对时以非0退出。
+'''
+
+import asyncio, logging, os, sys, tempfile, time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import orm, schema
+from app import logger_factory, identity_map_factory, conditional_factory, response_cache_factory, compression_factory, response_factory
+from app import init_response_cache, init_jinja2, datetime_filter
+from coroweb import get, add_route, build_manifest, add_routes_from_manifest
+from models import User, Blog, Comment, next_id
+from bench_orm import Bench, new_blog
+
+
+def _version(request):
+    return request.app['state']['version']
+
+@get('/bench/versioned', etag=_version, max_age=0)
+async def versioned(request):
+    state = request.app['state']
+    state['calls'] += 1
+    return dict(version=state['version'])
+
+@get('/bench/blogs')
+async def bench_blogs():
+    return {
+        '__template__': 'blogs.html',
+        'blogs': await Blog.findAll(orderBy='created_at desc', limit=10)
+    }
+
+@get('/bench/api/blogs')
+async def bench_api_blogs():
+    return dict(blogs=await Blog.findAll(orderBy='created_at desc', limit=10, compact=True))
+
+@get('/bench/cached', cache_ttl=60, cache_tags=(Blog,))
+async def bench_cached():
+    return dict(blogs=await Blog.findAll(orderBy='created_at desc', limit=10, compact=True))
+
+
+def new_app():
+    app = web.Application(middlewares=[logger_factory, identity_map_factory, conditional_factory, response_cache_factory, compression_factory, response_factory])
+    # app启动以后不能再修改app[...]，计数和版本号放在一个dict里
+    app['state'] = dict(version=1, calls=0)
+    init_response_cache(app)
+    init_jinja2(app, filters=dict(datetime=datetime_filter), globals=dict(static_url=lambda path: '/static/' + path))
+    return app
+
+async def check_versioned(bench, name, app):
+    state = app['state']
+    async with TestClient(TestServer(app)) as client:
+        with bench.step('%s: 200' % name):
+            r = await client.get('/bench/versioned')
+            assert r.status == 200, r.status
+            tag = r.headers['ETag']
+            assert (await r.json()) == dict(version=1) and state['calls'] == 1
+        with bench.step('%s: 304' % name, 100):
+            for i in range(100):
+                r = await client.get('/bench/versioned', headers={'If-None-Match': tag})
+                assert r.status == 304, r.status
+        # 304时处理函数一次都没有执行
+        assert state['calls'] == 1
+        state['version'] += 1
+        r = await client.get('/bench/versioned', headers={'If-None-Match': tag})
+        assert r.status == 200 and r.headers['ETag'] != tag and state['calls'] == 2
+
+async def load(client, path, n, concurrency, headers=None):
+    ' 并发concurrency个请求，一共n个，返回每个请求的延迟(秒，从小到大) '
+    latencies = []
+    async def worker(count):
+        for i in range(count):
+            start = time.perf_counter()
+            r = await client.get(path, headers=headers)
+            await r.read()
+            assert r.status == 200, (path, r.status)
+            latencies.append(time.perf_counter() - start)
+    await asyncio.gather(*[worker(n // concurrency + (1 if i < n % concurrency else 0)) for i in range(concurrency)])
+    return sorted(latencies)
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+async def run(n, concurrency):
+    bench = Bench()
+    app = new_app()
+    add_route(app, versioned)
+    await check_versioned(bench, 'add_route', app)
+
+    app = new_app()
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'routes.json')
+        build_manifest(['bench_web'], path)
+        assert add_routes_from_manifest(app, path)
+        await check_versioned(bench, 'manifest', app)
+
+    await orm.create_pool(None, driver='sqlite', db=':memory:')
+    await schema.create_tables([User, Blog, Comment])
+    user = User(id=next_id(), email='test@example.com', passwd='x', name='test', image='about:blank')
+    await user.save()
+    await Blog.save_many([new_blog(user, i) for i in range(100)])
+    app = new_app()
+    for fn in (bench_blogs, bench_api_blogs, bench_cached):
+        add_route(app, fn)
+    latencies = []
+    async with TestClient(TestServer(app)) as client:
+        for name, path, headers in (('template', '/bench/blogs', None),
+                                    ('json', '/bench/api/blogs', None),
+                                    ('json gzip', '/bench/api/blogs', {'Accept-Encoding': 'gzip'}),
+                                    ('cached', '/bench/cached', None)):
+            with bench.step(name, n):
+                latencies.append((name, await load(client, path, n, concurrency, headers)))
+    await orm.destroy_pool()
+    bench.report()
+    print()
+    for name, l in latencies:
+        print('%-28s p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms' % (name, percentile(l, 50) * 1000, percentile(l, 99) * 1000, l[-1] * 1000))
+
+
+if __name__ == '__main__':
+    # orm/models导入时设置了INFO(每个请求、每条sql都会打印)，跑分时只打印警告
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+                                                    int(sys.argv[2]) if len(sys.argv) > 2 else 20))
@@ -28,6 +28,16 @@ configs = {
     },
     'session': {
         'secret': 'Awesome'
+    },
+    # 生产环境在config_override.py里设置production=True(关闭auto_reload、bytecode cache、启动时编译模板)
+    # stream=True时模板用render_async渲染，返回'__stream__': True的页面分块发送
+    'jinja2': {
+        'production': False,
+        'stream': False
+    },
+    # /metrics的访问token，在config_override.py里设置；没有设置时只允许本机直接访问(不经过反向代理)
+    'metrics': {
+        'token': None
     }
         
 }
@@ -13,35 +13,49 @@ based on :
 https://github.com/justoneliu/web_app/blob/d5/www/webframe.py
 '''
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, json, importlib.util, sys, tempfile, codecs
 
 from urllib import parse
 from aiohttp import web
+from multidict import MultiDict
 from apis import APIError
+import assets
 
 
 #通过装饰器函数把一个函数映射为一个URL处理函数
 #Define decorator @get('/path')
-def get(path):
-     ' @get装饰器，Define decorator @get("/path") '
+def get(path, etag=None, max_age=None, cache_ttl=None, cache_tags=()):
+     '''
+     @get装饰器，Define decorator @get("/path")
+     etag：True表示按响应正文计算ETag；也可以是一个函数f(request)(可以是coroutine)，返回一个便宜的版本号
+           (例如最大的created_at)，版本号没变时不执行处理函数直接返回304，返回数字时同时作为Last-Modified
+     max_age：Cache-Control的max-age(秒)
+     cache_ttl：服务端响应缓存的秒数(见app.response_cache_factory)，只用于和当前用户无关的页面
+     cache_tags：响应依赖的Model(或者表名)，这些Model写入时清掉缓存的响应
+     '''
      def decorator(func):
          @functools.wraps(func)
          def wrapper(*args, **kw):
              return func(*args, **kw)
          wrapper.__method__ = 'GET'  #给处理函数绑定URL和HTTP method-GET的属性
          wrapper.__route__ = path  #给处理函数绑定URL和HTTP
+         wrapper.__etag__ = etag
+         wrapper.__max_age__ = max_age
+         wrapper.__cache_ttl__ = cache_ttl
+         wrapper.__cache_tags__ = [getattr(t, '__table__', t) for t in cache_tags]
          return wrapper
      return decorator
              
 #Define decorator @post("/path")
-def post(path):
-    ' @post装饰器，Define decorator @post("/path") '
+def post(path, max_body=None):
+    ' @post装饰器，Define decorator @post("/path")，max_body：请求正文的大小上限(字节)，默认MAX_BODY '
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'  #给处理函数绑定URL和HTTP method-GET的属性
         wrapper.__route__ = path     #给处理函数绑定URL和HTTP
+        wrapper.__max_body__ = max_body
         return wrapper
     return decorator
 
@@ -110,107 +124,360 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
     return found
 
+# 把字符串参数转换成处理函数参数注解的类型：def handler(*, page: int = 1, tags: list = None)
+_TRUE = frozenset(['1', 'true', 'yes', 'on'])
+_FALSE = frozenset(['0', 'false', 'no', 'off', ''])
+
+def _to_bool(v):
+    if isinstance(v, bool):
+        return v
+    s = str(v).lower()
+    if s in _TRUE:
+        return True
+    if s in _FALSE:
+        return False
+    raise ValueError('invalid bool value: %s' % v)
+
+# 路由清单(manifest)里用名字记录参数注解
+_ANNOTATIONS = dict(str=str, int=int, float=float, bool=bool, list=list)
+
+def _annotation_name(annotation):
+    ' 注解转换成可以写进manifest的名字，不支持的返回"?"(加载时重新分析签名)，没有注解返回None '
+    if annotation is inspect.Parameter.empty:
+        return None
+    for name, a in _ANNOTATIONS.items():
+        if annotation is a:
+            return name
+    if getattr(annotation, '__origin__', None) is list:
+        item = _annotation_name((getattr(annotation, '__args__', None) or (str,))[0])
+        if item in _ANNOTATIONS:
+            return 'list[%s]' % item
+    return '?'
+
+def _annotation_from_name(name):
+    if name is None:
+        return inspect.Parameter.empty
+    if name.startswith('list[') and name.endswith(']'):
+        return list[_ANNOTATIONS[name[5:-1]]]
+    return _ANNOTATIONS[name]
+
+def _converter(annotation):
+    ' 根据参数注解返回(转换函数, 是否是list)，没有注解或者注解是str时转换函数为None '
+    if annotation is inspect.Parameter.empty or annotation is str:
+        return None, False
+    if annotation is bool:
+        return _to_bool, False
+    if annotation in (int, float):
+        return annotation, False
+    if annotation is list:
+        return None, True
+    # list[int] / typing.List[int]
+    if getattr(annotation, '__origin__', None) is list:
+        item = (getattr(annotation, '__args__', None) or (str,))[0]
+        return _converter(item)[0], True
+    if callable(annotation):
+        return annotation, False
+    return None, False
+
+class _Param(object):
+    __slots__ = ('name', 'required', 'convert', 'is_list')
+
+    def __init__(self, name, required, convert, is_list):
+        self.name = name
+        self.required = required
+        self.convert = convert
+        self.is_list = is_list
+
+'''
+读取请求正文
+
+不用request.post()/request.json()把整个正文读进内存：
+正文按块读取，超过上限(默认MAX_BODY，@post(path, max_body=...)按路由设置)时返回413；
+multipart上传的文件写到SpooledTemporaryFile里(超过SPOOL_SIZE才落盘)，处理函数拿到的是UploadedFile；
+解析结果缓存在request里，middleware(例如app.data_factory)和处理函数只解析一次。
+'''
+
+MAX_BODY = 1024 * 1024
+SPOOL_SIZE = 256 * 1024
+_CHUNK_SIZE = 64 * 1024
+
+class UploadedFile(object):
+    ' multipart上传的文件，file已经seek(0)，请求处理完之后自动关闭 '
+    def __init__(self, name, filename, content_type, file, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = size
+
+    def __repr__(self):
+        return '<UploadedFile %s (%s, %s bytes)>' % (self.filename, self.content_type, self.size)
+
+def _too_large(max_body, size):
+    return web.HTTPRequestEntityTooLarge(max_size=max_body, actual_size=size)
+
+async def _read_limited(request, max_body):
+    if request.content_length is not None and request.content_length > max_body:
+        raise _too_large(max_body, request.content_length)
+    chunks = []
+    size = 0
+    while True:
+        chunk = await request.content.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_body:
+            raise _too_large(max_body, size)
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+async def _read_multipart(request, max_body, files):
+    if request.content_length is not None and request.content_length > max_body:
+        raise _too_large(max_body, request.content_length)
+    reader = await request.multipart()
+    items = []
+    size = 0
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        if not hasattr(part, 'read_chunk'):
+            # 嵌套的multipart/mixed，不支持
+            raise web.HTTPBadRequest(text='Nested multipart is not supported.')
+        if part.filename:
+            out = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            files.append(out)
+        else:
+            out = bytearray()
+        part_size = 0
+        while True:
+            chunk = await part.read_chunk(_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_body:
+                raise _too_large(max_body, size)
+            part_size += len(chunk)
+            if part.filename:
+                out.write(chunk)
+            else:
+                out.extend(chunk)
+        if part.filename:
+            out.seek(0)
+            items.append((part.name, UploadedFile(part.name, part.filename, part.headers.get('Content-Type'), out, part_size)))
+        else:
+            try:
+                items.append((part.name, out.decode(part.get_charset('utf-8'))))
+            except (LookupError, UnicodeDecodeError):
+                raise web.HTTPBadRequest(text='Invalid charset of form field: %s' % part.name)
+    return MultiDict(items)
+
+async def read_body(request, max_body=None):
+    '''
+    读取并解析POST正文，返回(参数, 是否是MultiDict)，不支持的正文类型返回(None, False)。
+    超过大小上限时抛出HTTPRequestEntityTooLarge，JSON格式错误、charset不认识或者解码失败时抛出HTTPBadRequest。
+    '''
+    if '__body__' in request:
+        return request['__body__']
+    if max_body is None:
+        max_body = MAX_BODY
+    ct = request.content_type.lower()
+    charset = request.charset or 'utf-8'
+    try:
+        # charset来自客户端的Content-Type，不认识的编码(LookupError)按请求错误处理
+        codecs.lookup(charset)
+    except LookupError:
+        raise web.HTTPBadRequest(text='Unknown charset: %s' % charset)
+    if ct.startswith('application/json'):
+        try:
+            body = (json.loads((await _read_limited(request, max_body)).decode(charset)), False)
+        except ValueError:
+            raise web.HTTPBadRequest(text='Invalid JSON body.')
+    elif ct.startswith('application/x-www-form-urlencoded'):
+        try:
+            qs = (await _read_limited(request, max_body)).decode(charset)
+        except UnicodeDecodeError:
+            raise web.HTTPBadRequest(text='Invalid form body.')
+        body = (MultiDict(parse.parse_qsl(qs, keep_blank_values=True)), True)
+    elif ct.startswith('multipart/form-data'):
+        files = request['__files__'] = []
+        body = (await _read_multipart(request, max_body, files), True)
+    else:
+        body = (None, False)
+    request['__body__'] = body
+    return body
+
+def release_body(request):
+    ' 关闭multipart上传的临时文件 '
+    for f in request.pop('__files__', ()):
+        f.close()
+
+def handler_spec(fn):
+    '''
+    分析处理函数的签名(只调用一次inspect.signature)，返回dict：
+    request: 是否有request参数, var_kw: 是否有**kw,
+    params: [dict(name, keyword(是否是命名关键字参数), required, annotation)]
+    '''
+    spec = dict(request=has_request_arg(fn), var_kw=False, params=[])
+    for name, param in inspect.signature(fn).parameters.items():
+        if param.kind == inspect.Parameter.VAR_KEYWORD:
+            spec['var_kw'] = True
+        elif name != 'request' and param.kind != inspect.Parameter.VAR_POSITIONAL:
+            spec['params'].append(dict(name=name, keyword=param.kind == inspect.Parameter.KEYWORD_ONLY,
+                                       required=param.default is inspect.Parameter.empty, annotation=param.annotation))
+    return spec
+
+def spec_to_json(spec):
+    params = [dict(p, annotation=_annotation_name(p['annotation'])) for p in spec['params']]
+    return dict(spec, params=params)
+
+def spec_from_json(spec):
+    ' manifest里的参数信息转换回handler_spec()的格式，有不支持的注解时返回None '
+    if any(p['annotation'] == '?' for p in spec['params']):
+        return None
+    params = [dict(p, annotation=_annotation_from_name(p['annotation'])) for p in spec['params']]
+    return dict(spec, params=params)
+
 #定义RequestHandler,正式向request参数获取URL处理函数所需的参数
 class RequestHandler(object):
     ' 请求处理器，用来封装处理函数 '
-    def __init__(self, app, fn):
+    def __init__(self, app, fn, spec=None):
         # app : an application instance for registering the fn
         # fn : a request handler with a particular HTTP method and path
+        # spec : handler_spec(fn)的结果，从路由清单加载时直接传入，不用再分析签名
+        # 在注册路由的时候把处理函数的签名分析好，每次请求只按预先算好的参数列表取值、转换类型
         self._app = app
         self._func = fn
-        self._has_request_arg = has_request_arg(fn)  # 检查函数是否有request参数
-        self._has_var_kw_arg = has_var_kw_arg(fn)     # 检查函数是否有关键字参数集
-        self._has_named_kw_args = has_named_kw_args(fn)   # 检查函数是否有命名关键字参数
-        self._named_kw_args = get_named_kw_args(fn)   # 将函数所有的 命名关键字参数名 作为一个tuple返回
-        self._required_kw_args = get_required_kw_args(fn)  # 将函数所有 没默认值的 命名关键字参数名 作为一个tuple返回
+        self.max_body = getattr(fn, '__max_body__', None)
+        self.etag = getattr(fn, '__etag__', None)
+        self.max_age = getattr(fn, '__max_age__', None)
+        self.cache_ttl = getattr(fn, '__cache_ttl__', None)
+        self.cache_tags = getattr(fn, '__cache_tags__', [])
+        if spec is None:
+            spec = handler_spec(fn)
+        self._has_request_arg = spec['request']  # 检查函数是否有request参数
+        self._has_var_kw_arg = spec['var_kw']    # 是否有**kw
+        self._params = []              # 命名关键字参数：从POST正文或者query string里取值
+        self._converters = dict()      # 有类型注解的参数(包括URL里的参数) -> (转换函数, 是否是list)
+        for p in spec['params']:
+            convert, is_list = _converter(p['annotation'])
+            if convert is not None or is_list:
+                self._converters[p['name']] = (convert, is_list)
+            if p['keyword']:
+                self._params.append(_Param(p['name'], p['required'], convert, is_list))
+        self._named_kw_args = tuple(p.name for p in self._params)   # 所有的命名关键字参数名
+        self._required_kw_args = tuple(p.name for p in self._params if p.required)  # 没默认值的命名关键字参数名
+        # 需要读取请求参数(POST正文或者query string)
+        self._need_args = self._has_var_kw_arg or bool(self._params)
+
+    async def _read_args(self, request):
+        ' 读取POST正文或者query string，返回(参数来源, 是否是MultiDict)，出错时返回Response '
+        if request.method == 'POST':
+            # 无正文类型信息时返回
+            if not request.content_type:
+                return web.HTTPBadRequest(text='Missing Content-Type.'), False #这里被廖大坑了，要有text
+            # 处理JSON和表单类型的数据，middleware已经读过正文时直接用缓存的结果
+            try:
+                params, multi = await read_body(request, self.max_body)
+            except web.HTTPException as e:
+                return e, False
+            # 暂不支持处理其他正文类型的数据
+            if params is None:
+                return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type), False
+            if not multi and not isinstance(params, dict):
+                return web.HTTPBadRequest(text='JSON body must be object.'), False
+            return params, multi
+        if request.method == 'GET' and request.query_string:
+            # aiohttp已经解析好了query string(request.query，MultiDict)，不用再parse_qs一遍
+            return request.query, True
+        return None, False
+
+    async def version(self, request):
+        ' 调用@get(path, etag=f)的f，返回版本号 '
+        r = self.etag(request)
+        if inspect.isawaitable(r):
+            r = await r
+        return r
+
+    def _convert(self, name, value, convert, is_list):
+        if is_list and not isinstance(value, list):
+            value = [value]
+        if convert is None:
+            return value
+        try:
+            if is_list:
+                return [convert(v) for v in value]
+            return convert(value)
+        except (ValueError, TypeError):
+            raise web.HTTPBadRequest(text='Invalid argument: %s' % name)
 
     async def __call__(self, request):
         ' 分析请求，request handler,must be a coroutine that accepts a request instance as its only argument and returns a streamresponse derived instance '
-        kw = None
-        # 当传入的处理函数具有 关键字参数集 或 命名关键字参数 或 request参数
-        if self._has_var_kw_arg or self._has_named_kw_args  or self._required_kw_args:
-            # POST请求预处理
-            if request.method == 'POST':
-                # 无正文类型信息时返回
-                if not request.content_type:
-                    return web.HTTPBadRequest(text='Missing Content-Type.') #这里被廖大坑了，要有text
-                ct = request.content_type.lower()
-                # 处理JSON类型的数据，传入参数字典中
-                if ct.startswith('application/json'):
-                    params = await request.json()   #Read request body decoded as json.
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest(text='JSON body must be object.')
-                    kw = params
-                # 处理表单类型的数据，传入参数字典中
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                # 暂不支持处理其他正文类型的数据
+        try:
+            return await self._handle(request)
+        finally:
+            release_body(request)
+
+    async def _handle(self, request):
+        kw = dict()
+        if self._need_args:
+            source, multi = await self._read_args(request)
+            if isinstance(source, web.StreamResponse):
+                return source
+            if source is not None:
+                if self._has_var_kw_arg:
+                    # 有**kw时所有参数都传进去
+                    for k in source.keys():
+                        kw[k] = source[k]
+                    if multi:
+                        for p in self._params:
+                            if p.is_list and p.name in source:
+                                kw[p.name] = source.getall(p.name)
                 else:
-                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
-            # GET请求预处理
-            if request.method == 'GET':
-                #在World Wide Web上, query string是Uniform Resource Locator (URL)的一部分, 其中包含着需要传给web application的数据.
-                #当通过HTTP请求一个页面的时候, 服务器根据请求的URL来在文件系统中定位到请求的文件. 这个文件可能是一个普通的文件, 也可能是一个程序. 
-                #如果是第二种情况的话, 服务器需要运行这个程序, 之后把运行的结果作为一个页面返回. query string是传递给这个程序的URL的一部分, 通过对它的使用, 可以允许我们从HTTP的client端发送数据给生成web page的应用程序.
-                #Query String Parameters是类似这种格式的
-                #site: qq
-                #state: CODE-gz-1GeqpT-1RHINN-XHbQexRheevNP7U759169
-                #bentry: homepage
-                #wl: 1
-                #callback: https%3A%2F%2Fwww.sina.com.cn%2F
-                #code: 0DCF7C2E544C63529D82C588B403A28C
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        #Parse a query string given as a string argument.Data are returned as a dictionary. The dictionary keys are the unique query variable names and the values are lists of values for each name.
-                        # parse a query string, data are returned as a dict. the dict keys are the unique query variable names and the values are lists of values for each name
-                        # a True value indicates that blanks should be retained as blank strings
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-            # Read-only property with AbstractMatchInfo instance for result of route resolving
+                    # 只取命名关键字参数，其他的参数直接忽略
+                    for p in self._params:
+                        if p.name in source:
+                            kw[p.name] = source.getall(p.name) if (multi and p.is_list) else source[p.name]
+                for k, v in request.match_info.items():
+                    if k in kw:
+                        logging.warning('Duplicate arg name in named args and kw args: %s' % k)
+                    kw[k] = v
+            else:
+                kw.update(request.match_info)
         else:
-            # 参数字典收集请求参数
-            # #当函数参数没有关键字参数时，移去request除命名关键字参数所有的参数信息
-            if not self._has_var_kw_arg and self._named_kw_args:
-                #remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
+            # Read-only property with AbstractMatchInfo instance for result of route resolving
+            kw.update(request.match_info)
+        #check required kw # 收集无默认值的关键字参数
+        ##假如命名关键字参数(没有附加默认值)，request没有提供相应的数值，报错
+        for name in self._required_kw_args:
+            if not name in kw:
+                # 当存在关键字参数未被赋值时返回，例如 一般的账号注册时，没填入密码就提交注册申请时，提示密码未输入
+                return web.HTTPBadRequest(text='Missing argument: %s' % name)
+        # 按参数注解转换类型
+        if self._converters:
+            try:
+                for name, (convert, is_list) in self._converters.items():
                     if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            #check named arg:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named args and kw args: %s' % k)
-                kw[k] = v                                
-                
+                        kw[name] = self._convert(name, kw[name], convert, is_list)
+            except web.HTTPBadRequest as e:
+                return e
         if self._has_request_arg:
             kw['request'] = request
-        #check required kw # 收集无默认值的关键字参数
-        ##假如命名关键字参数(没有附加默认值)，request没有提供相应的数值，报错
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    # 当存在关键字参数未被赋值时返回，例如 一般的账号注册时，没填入密码就提交注册申请时，提示密码未输入
-                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
-        logging.info('Call with args: %s' % str(kw))
+        logging.debug('Call with args: %s', kw)
         try:
             # 最后调用URL处理函数，并传入请求参数，进行请求处理
             r = await self._func(**kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
-    
+
 
 def add_static(app):
-    ' 添加静态资源路径 '
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static') #获得包含'static'的绝对路径
+    ' 添加静态资源路径，带hash的URL、预先压缩、immutable缓存见assets.py，返回assets.StaticHandler '
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(here, 'static') #获得包含'static'的绝对路径
     # os.path.dirname(os.path.abspath(__file__)) 返回脚本所在目录的绝对路径
-    app.router.add_static('/static/', path)  # 添加静态资源路径
-    logging.info('add static %s => %s' % ('/static/', path))
+    return assets.add_assets(app, path, os.path.join(here, 'static_build'))  # 添加静态资源路径
 
 
 
@@ -218,7 +485,7 @@ def add_static(app):
 
 #add_route函数用来注册一个URL处理函数（这些URL处理函数后续都是放在handlers.py文件中的）
 #其实就是将URL处理函数注册到web服务的路由中
-def add_route(app, fn):
+def add_route(app, fn, spec=None):
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
@@ -226,26 +493,27 @@ def add_route(app, fn):
     #就是判断如果URL处理函数如果不是coroutine的话就先将其转化为coroutine，满足异步处理的
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn)
-    logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ','.join(inspect.signature(fn).parameters.keys())))
+    handler = RequestHandler(app, fn, spec)
+    logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ','.join(p.name for p in handler._params)))
     #这句话就是这个函数的重点，app其实是调用aiohttp生成的，这句话就是将URL处理函数注册到app.router.add_route()
     #我的理解其实是将URL函数与具体的app关联起来的
-    app.router.add_route(method, path, RequestHandler(app, fn))  #别忘了RequestHandler的参数有两个
+    app.router.add_route(method, path, handler)  #别忘了RequestHandler的参数有两个
 
 
-#如果多次调用add_route()函数将handlers中的URL处理函数都注册到app.router.add_route()， 会显得很麻烦
-# 自动把handlers模块(存放URL处理函数的模块)的所有符合条件的函数注册了:
-#把原来的add_route(app, fn)改写成add_route(app, module_name)
-def add_routes(app, module_name):
+def _import_module(module_name):
     n = module_name.rfind('.')  #先查看module_name中是否有'.', 例如module_name = test.test1
     if n == (-1):   #n=-1代表着没有在module_name中找到'.'， 说明这个module与该add_routes函数所在的py文件属于同一个目录下
         #__import__(name, globals=None, locals=None, fromlist=(), level=0)
-        mod = __import__(module_name, globals(), locals())
-    else:
-        # __import__(package.module)相当于from package import name，如果fromlist不传入值，则返回package对应的模块，如果fromlist传入值，则返回package.module对应的模块。
-        name = module_name[n+1:]  #在module_name中找到'.'， 那么name就是类似例子中的test1
-        #getattr(object, name[, default])
-        #getattr() 函数用于返回一个对象属性值。
-        mod = getattr(__import__(module_name[:n], globals(), locals(),[name]), name)
+        return __import__(module_name, globals(), locals())
+    # __import__(package.module)相当于from package import name，如果fromlist不传入值，则返回package对应的模块，如果fromlist传入值，则返回package.module对应的模块。
+    name = module_name[n+1:]  #在module_name中找到'.'， 那么name就是类似例子中的test1
+    #getattr(object, name[, default])
+    #getattr() 函数用于返回一个对象属性值。
+    return getattr(__import__(module_name[:n], globals(), locals(),[name]), name)
+
+def _module_routes(mod):
+    ' 返回模块里所有用@get/@post装饰过的函数：[(属性名, 函数)] '
+    routes = []
     for attr in dir(mod):
         if attr.startswith('_'):  #'_'开头代表是module私有的属性，一般情况下是不允许外部使用的
             continue
@@ -255,30 +523,106 @@ def add_routes(app, module_name):
             path = getattr(fn, '__route__', None)
             if method and path:
                 #这里要查询path以及method是否存在而不是等待add_route函数查询，因为那里错误就要报错了
-                # 对已经修饰过的URL处理函数注册到web服务的路由中
-                add_route(app, fn)
-            
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+                routes.append((attr, fn))
+    return routes
 
+#如果多次调用add_route()函数将handlers中的URL处理函数都注册到app.router.add_route()， 会显得很麻烦
+# 自动把handlers模块(存放URL处理函数的模块)的所有符合条件的函数注册了:
+#把原来的add_route(app, fn)改写成add_route(app, module_name)
+def add_routes(app, module_name):
+    for attr, fn in _module_routes(_import_module(module_name)):
+        # 对已经修饰过的URL处理函数注册到web服务的路由中
+        add_route(app, fn)
 
 
+'''
+路由清单(route manifest)
 
+add_routes()启动时要import handlers模块(连带models、orm)，并且分析每个处理函数的签名。
+部署时先生成路由清单：
 
+python coroweb.py handlers              生成routes.json
 
+app启动时add_routes_from_manifest()直接按清单注册路由，处理函数所在的模块在第一次请求时才import。
+清单里记录了模块文件的修改时间和大小，模块改过之后清单失效，返回False，这时应该退回到add_routes()。
+'''
 
+def _module_stamp(module_name):
+    ' 模块文件的(修改时间, 大小)，不需要import模块 '
+    spec = importlib.util.find_spec(module_name)
+    if spec is None or not spec.origin or not os.path.isfile(spec.origin):
+        return None
+    st = os.stat(spec.origin)
+    return [st.st_mtime, st.st_size]
+
+def _etag_option(fn):
+    # 版本号函数不能写进清单，记成'version'，用的时候再import模块
+    etag = getattr(fn, '__etag__', None)
+    return 'version' if callable(etag) else etag
+
+def build_manifest(module_names, path):
+    ' 生成路由清单，返回路由的数量 '
+    routes = []
+    modules = dict()
+    for module_name in module_names:
+        modules[module_name] = _module_stamp(module_name)
+        for attr, fn in _module_routes(_import_module(module_name)):
+            routes.append(dict(method=fn.__method__, path=fn.__route__, module=module_name, function=attr,
+                               max_body=getattr(fn, '__max_body__', None), etag=_etag_option(fn),
+                               max_age=getattr(fn, '__max_age__', None), cache_ttl=getattr(fn, '__cache_ttl__', None),
+                               cache_tags=getattr(fn, '__cache_tags__', []), args=spec_to_json(handler_spec(fn))))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(dict(modules=modules, routes=routes), f, ensure_ascii=False, indent=1)
+    return len(routes)
+
+class LazyRequestHandler(object):
+    ' 第一次请求时才import处理函数所在的模块，之后直接交给RequestHandler '
+    def __init__(self, app, route):
+        self._app = app
+        self._route = route
+        self._handler = None
+        self.max_body = route.get('max_body')
+        self.etag = route.get('etag')
+        self.max_age = route.get('max_age')
+        self.cache_ttl = route.get('cache_ttl')
+        self.cache_tags = route.get('cache_tags', [])
+
+    def _load(self):
+        if self._handler is None:
+            route = self._route
+            fn = getattr(_import_module(route['module']), route['function'])
+            if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
+                fn = asyncio.coroutine(fn)
+            self._handler = RequestHandler(self._app, fn, spec_from_json(route['args']))
+            logging.info('load route %s %s => %s.%s' % (route['method'], route['path'], route['module'], route['function']))
+        return self._handler
+
+    async def version(self, request):
+        return await self._load().version(request)
 
+    async def __call__(self, request):
+        return await self._load()(request)
+
+def add_routes_from_manifest(app, path):
+    ' 按路由清单注册路由，清单不存在或者已经过期时返回False '
+    if not os.path.isfile(path):
+        return False
+    with open(path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    for module_name, stamp in manifest['modules'].items():
+        if _module_stamp(module_name) != stamp:
+            logging.warning('route manifest %s is out of date (%s changed)' % (path, module_name))
+            return False
+    for route in manifest['routes']:
+        app.router.add_route(route['method'], route['path'], LazyRequestHandler(app, route))
+    logging.info('add %s routes from manifest %s' % (len(manifest['routes']), path))
+    return True
+
+
+if __name__ == '__main__':
+    # python coroweb.py handlers [routes.json]
+    if len(sys.argv) < 2:
+        print('Usage: python coroweb.py module_name [manifest_path]')
+        sys.exit(1)
+    out = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes.json')
+    print('%s routes => %s' % (build_manifest(sys.argv[1].split(','), out), out))
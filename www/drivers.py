@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 30 10:12:05 2018
+
+@author: keen_liu
+"""
+
+
+'''
+ORM的数据库驱动层
+
+orm.py只通过driver对象访问数据库，每个driver提供：
+create_pool(loop, kw)   创建连接池，连接池要支持 async with pool.get() as conn，以及size/freesize/minsize/maxsize/close()/wait_closed()
+cursor(conn, kind)      取一个游标，kind是'dict'(每行一个dict)、'tuple'(普通tuple行)、'stream'(服务端游标，逐批读取)
+errors                  数据库异常，select在从库上遇到这些异常时用is_connection_error()判断是不是连接断了
+is_connection_error(e)  连接级的异常(连不上、连接断开)返回True，这时从库标记为不可用、切换到主库；
+                        sql错误、锁等待超时这类查询级的异常返回False，直接抛出，不影响从库的健康状态
+health_errors           从库健康检查时认为从库不可用的异常
+approximate_count       读取表的近似行数的sql(参数是表名，结果列名_num_)，不支持时为None
+columns_sql             读取表结构的sql(参数是表名，结果列name, column_type)，schema.py用来和Model比较
+indexes_sql             读取表的二级索引的sql(参数是表名，结果列name, col, non_unique，按索引内的顺序)
+                        结果列都要用as写明小写的列名：MySQL 8的information_schema返回大写的列名(COLUMN_TYPE)
+
+连接需要支持 begin()/commit()/rollback()/ping()，游标需要支持 execute()/fetchall()/fetchmany()/rowcount，
+orm生成的sql统一是%s风格(%要写成%%)，由driver负责转换成自己的格式。
+
+目前有两个driver：
+mysql   aiomysql，生产环境使用
+sqlite  标准库sqlite3，放到线程池里执行，不需要数据库服务器，用于CI上跑测试和性能回归：
+        await orm.create_pool(loop, driver='sqlite', db=':memory:')
+'''
+
+import asyncio, functools, logging, re, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MySQLDriver(object):
+    name = 'mysql'
+    # InnoDB的统计信息，不需要扫描全表，误差可能有百分之几十，只适合分页显示之类的场景
+    approximate_count = 'select table_rows _num_ from information_schema.tables where table_schema = database() and table_name = %s'
+    columns_sql = 'select column_name as name, column_type as column_type from information_schema.columns where table_schema = database() and table_name = %s order by ordinal_position'
+    indexes_sql = "select index_name as name, column_name as col, non_unique as non_unique from information_schema.statistics where table_schema = database() and table_name = %s and index_name != 'PRIMARY' order by index_name, seq_in_index"
+
+    def __init__(self):
+        try:
+            import aiomysql
+        except ImportError:
+            raise RuntimeError('driver mysql requires aiomysql, please pip install aiomysql')
+        self._aiomysql = aiomysql
+        self.errors = (aiomysql.OperationalError, OSError)
+        self.health_errors = (aiomysql.Error, OSError, asyncio.TimeoutError)
+        self._cursors = dict(dict=aiomysql.DictCursor, tuple=aiomysql.Cursor, stream=aiomysql.SSDictCursor)
+
+    async def create_pool(self, loop, kw):
+        #dict有一个get方法，如果dict中有对应的value值，则返回对应于key的value值，否则返回默认值，例如下面的host，如果dict里面没有
+        #'host',则返回后面的默认值，也就是'localhost'
+        #这里有一个关于Pool的连接，讲了一些Pool的知识点，挺不错的，点击打开链接，下面这些参数都会讲到，以及destroy__pool里面的
+        #https://aiomysql.readthedocs.io/en/latest/pool.html
+        #wait_closed()
+        return await self._aiomysql.create_pool(
+                host = kw.get('host', 'localhost'),
+                port = kw.get('port', 3306),
+                user = kw['user'],
+                password = kw['password'],
+                db = kw['db'],
+                charset = kw.get('charset', 'utf8'),
+                autocommit = kw.get('autocommit', True),  #默认自动提交事务，不用手动去提交事务
+                maxsize = kw.get('maxsize', 10),
+                minsize = kw.get('minsize', 1),
+                loop = loop  #loop – is an optional event loop instance, asyncio.get_event_loop() is used if loop is not specified.
+            )
+
+    # 2003: Can't connect to MySQL server, 2006: MySQL server has gone away, 2013: Lost connection to MySQL server during query
+    # 其他OperationalError(1054 unknown column、1205 lock wait timeout、3024 max_execution_time...)是查询本身的问题
+    CONNECTION_ERRNOS = (2003, 2006, 2013)
+
+    def is_connection_error(self, e):
+        if isinstance(e, OSError):
+            return True
+        return bool(e.args) and e.args[0] in self.CONNECTION_ERRNOS
+
+    def cursor(self, conn, kind='dict'):
+        return conn.cursor(self._cursors[kind])
+
+
+# ------------------------------------------------------------------
+# sqlite：每个连接一个单线程的executor，所有sqlite3调用都在这个线程里执行，不阻塞事件循环
+# ------------------------------------------------------------------
+
+_RE_PARAM = re.compile(r'%s|%%')
+
+# 把orm的%s风格sql转换成sqlite3的?风格，结果缓存
+@functools.lru_cache(maxsize=1024)
+def sqlite_sql(sql):
+    return _RE_PARAM.sub(lambda m: '?' if m.group(0) == '%s' else '%', sql)
+
+def _dict_factory(cursor, row):
+    return dict(zip([d[0] for d in cursor.description], row))
+
+class SQLiteCursor(object):
+    def __init__(self, conn, kind):
+        self._conn = conn
+        self._kind = kind
+        self._cur = None
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        self._cur = await self._conn._run(self._conn._db.cursor)
+        if self._kind != 'tuple':
+            self._cur.row_factory = _dict_factory
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
+
+    async def execute(self, sql, args=None):
+        await self._conn._run(self._cur.execute, sqlite_sql(sql), tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+        return self.rowcount
+
+    async def fetchall(self):
+        return await self._conn._run(self._cur.fetchall)
+
+    async def fetchmany(self, size=1):
+        return await self._conn._run(self._cur.fetchmany, size)
+
+    async def fetchone(self):
+        return await self._conn._run(self._cur.fetchone)
+
+    async def close(self):
+        if self._cur is not None:
+            cur, self._cur = self._cur, None
+            await self._conn._run(cur.close)
+
+class SQLiteConnection(object):
+    def __init__(self, executor, db):
+        self._executor = executor
+        self._db = db
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    def cursor(self, kind='dict'):
+        return SQLiteCursor(self, kind)
+
+    async def begin(self):
+        await self._run(self._db.execute, 'begin')
+
+    async def commit(self):
+        await self._run(self._db.commit)
+
+    async def rollback(self):
+        await self._run(self._db.rollback)
+
+    async def ping(self, reconnect=True):
+        await self._run(self._db.execute, 'select 1')
+
+    async def close(self):
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=False)
+
+class _PoolConnection(object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool.acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        conn, self._conn = self._conn, None
+        self._pool.release(conn)
+
+class SQLitePool(object):
+    '''
+    sqlite连接池。:memory:数据库每个连接都是独立的一个库，所以:memory:时连接池只有一个连接；
+    这时不要在select_iter迭代的过程中再执行别的查询(连接已经被占用，会一直等待)。
+    '''
+    def __init__(self, database, minsize=1, maxsize=5):
+        self.database = database
+        if database == ':memory:':
+            minsize = maxsize = 1
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._free = []
+        self._all = []
+        self._waiters = []
+        self._opening = 0   # 正在打开的连接数：await _open()之前先占位，并发acquire时不会超过maxsize
+        self._closed = False
+
+    @property
+    def size(self):
+        return len(self._all)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    def _connect(self):
+        # isolation_level=None：自动提交，和aiomysql的autocommit=True一致，事务由begin()显式开始
+        return sqlite3.connect(self.database, isolation_level=None, check_same_thread=False)
+
+    async def _open(self):
+        self._opening += 1
+        try:
+            executor = ThreadPoolExecutor(max_workers=1)
+            db = await asyncio.get_event_loop().run_in_executor(executor, self._connect)
+        except BaseException:
+            # 打开失败，让出位置给等待的acquire
+            self._wakeup()
+            raise
+        finally:
+            self._opening -= 1
+        conn = SQLiteConnection(executor, db)
+        self._all.append(conn)
+        return conn
+
+    async def fill(self):
+        while self.size + self._opening < self.minsize:
+            self.release(await self._open())
+
+    def get(self):
+        return _PoolConnection(self)
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError('Cannot acquire connection after closing pool')
+        while True:
+            if self._free:
+                return self._free.pop()
+            if self.size + self._opening < self.maxsize:
+                return await self._open()
+            fut = asyncio.get_event_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut
+            except BaseException:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+                elif fut.done() and not fut.cancelled():
+                    # 已经被release()唤醒，还没来得及取连接就被取消了：把唤醒让给下一个等待的acquire
+                    self._wakeup()
+                raise
+
+    def release(self, conn):
+        self._free.append(conn)
+        self._wakeup()
+
+    def _wakeup(self):
+        while self._waiters:
+            fut = self._waiters.pop(0)
+            if not fut.done():
+                fut.set_result(None)
+                break
+
+    def close(self):
+        self._closed = True
+
+    async def wait_closed(self):
+        for conn in self._all:
+            await conn.close()
+        self._all = []
+        self._free = []
+
+class SQLiteDriver(object):
+    name = 'sqlite'
+    approximate_count = None
+    columns_sql = 'select name, type as column_type from pragma_table_info(%s) order by cid'
+    indexes_sql = "select il.name as name, ii.name as col, not il.\"unique\" as non_unique from pragma_index_list(%s) il join pragma_index_info(il.name) ii where il.origin != 'pk' order by il.name, ii.seqno"
+    errors = (sqlite3.OperationalError,)
+    health_errors = (sqlite3.Error,)
+
+    def is_connection_error(self, e):
+        # sqlite3对"no such column"之类的sql错误也抛OperationalError，只有打不开数据库文件才算连接级的错误
+        return isinstance(e, OSError) or str(e).startswith(('unable to open database', 'disk I/O error'))
+
+    async def create_pool(self, loop, kw):
+        pool = SQLitePool(kw.get('db', None) or kw.get('database', ':memory:'), kw.get('minsize', 1), kw.get('maxsize', 5))
+        await pool.fill()
+        logging.info('sqlite database: %s' % pool.database)
+        return pool
+
+    def cursor(self, conn, kind='dict'):
+        return conn.cursor(kind)
+
+
+DRIVERS = dict(mysql=MySQLDriver, sqlite=SQLiteDriver)
+
+def get_driver(driver):
+    ' driver可以是名字(mysql/sqlite)，也可以直接是driver对象 '
+    if not isinstance(driver, str):
+        return driver
+    if driver not in DRIVERS:
+        raise ValueError('Unknown database driver: %s' % driver)
+    return DRIVERS[driver]()
@@ -9,10 +9,11 @@ Created on Mon Oct 22 16:24:01 2018
 URL handlers
 '''
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, logging, hashlib, hmac, base64, asyncio
 
 from aiohttp import web
 
+import orm, jsonenc
 
 from coroweb import get, post
 from models import User, Blog, Comment, next_id
@@ -33,7 +34,8 @@ async def index(request):
 '''
 
 #test for day8
-@get('/')
+# 首页的ETag按渲染出来的正文计算，内容没变时只返回304；服务端缓存10秒，blogs写入时清掉
+@get('/', etag=True, cache_ttl=10, cache_tags=(Blog,))
 async def index(request):
     summary = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
     blogs = [
@@ -48,15 +50,39 @@ async def index(request):
 
 
 #test for day9
-@get('/api/users')
+# 用户信息会被修改、删除，max(created_at)之类的版本号发现不了这些变化，ETag按正文计算；
+# 正文一般来自服务端缓存(User写入时清掉)，计算ETag只是一次sha1
+@get('/api/users', etag=True, cache_ttl=30, cache_tags=(User,))
 async def api_get_users():
-    users = await User.findAll(orderBy='created_at desc')
+    users = await User.findAll(orderBy='created_at desc', compact=True)
     for u in users:
         u.passwd = '******'
     return dict(users=users)
 
 
 
+#连接池和sql的统计信息，用来判断延迟高是因为等待连接(连接池不够)还是MySQL慢
+#里面有sql语句和连接池配置，不能公开：配置了configs.metrics.token时要带Authorization: Bearer <token>，
+#没有配置时只允许本机直接访问(例如ssh到服务器上curl 127.0.0.1:9000/metrics)
+_LOCAL_ADDRS = ('127.0.0.1', '::1')
+#app只监听127.0.0.1，外面的请求都经过反向代理(nginx)转发，remote也是127.0.0.1，只能按代理加的头区分
+_PROXY_HEADERS = ('Forwarded', 'X-Forwarded-For', 'X-Real-IP')
+
+def _metrics_allowed(request):
+    token = configs.metrics.token
+    if token:
+        auth = request.headers.get('Authorization', '')
+        return hmac.compare_digest(auth.encode('utf-8'), ('Bearer %s' % token).encode('utf-8'))
+    return request.remote in _LOCAL_ADDRS and not any(h in request.headers for h in _PROXY_HEADERS)
+
+@get('/metrics')
+async def metrics(request):
+    if not _metrics_allowed(request):
+        raise web.HTTPForbidden()
+    return orm.stats()
+
+
+
 #test for day10
 COOKIE_NAME = 'awesession'   #用来在set_cookie中命名
 _COOKIE_KEY = configs.session.secret  #导入默认设置
@@ -112,7 +138,7 @@ async def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)  #max_age是cookie信息有效的时间86400s就是24hours
     user.passwd = '******'  #掩盖passwd
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = jsonenc.dumps(user)
     return r
 
 """
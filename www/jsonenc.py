@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Nov  1 09:47:26 2018
+
+@author: keen_liu
+"""
+
+
+'''
+JSON编码
+
+API的响应都要json序列化，原来每次都是json.dumps(..., default=lambda o: o.__dict__).encode('utf-8')：
+每次调用都重新构造JSONEncoder，default对__slots__对象(orm.CompactRow)会失败，最后还要再encode复制一次。
+
+dumps(obj)直接返回utf-8的bytes：
+装了orjson时用orjson(C实现，直接输出bytes)，否则用标准库json(模块级的JSONEncoder，只构造一次)。
+Model本身是dict，两种实现都直接按dict序列化，不经过default；
+CompactRow按类预先生成编码函数(按__slots__的列顺序一次取出所有属性)，结果缓存在_encoders里；
+其他类型可以用register(type, fn)注册编码函数，fn返回可以序列化的对象。
+'''
+
+import json, operator, logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import orm
+
+
+_encoders = dict()  # type -> fn(obj)，返回可以json序列化的对象
+
+def register(type_, fn):
+    ' 注册type_的编码函数 '
+    _encoders[type_] = fn
+
+def _row_encoder(cls):
+    columns = cls.__slots__
+    if len(columns) == 1:
+        get = operator.attrgetter(columns[0])
+        return lambda o: {columns[0]: get(o)}
+    get = operator.attrgetter(*columns)
+    return lambda o: dict(zip(columns, get(o)))
+
+def _find_encoder(cls):
+    if issubclass(cls, orm.CompactRow):
+        return _row_encoder(cls)
+    if hasattr(cls, '_asdict'):
+        return cls._asdict
+    for t, fn in _encoders.items():
+        if issubclass(cls, t):
+            return fn
+    return None
+
+def default(o):
+    ' json的default：按类型取预先生成的编码函数 '
+    cls = type(o)
+    fn = _encoders.get(cls)
+    if fn is None:
+        fn = _find_encoder(cls)
+        if fn is None:
+            if not hasattr(o, '__dict__'):
+                raise TypeError('Object of type %s is not JSON serializable' % cls.__name__)
+            fn = operator.attrgetter('__dict__')
+        _encoders[cls] = fn
+    return fn(o)
+
+
+_std_encoder = json.JSONEncoder(ensure_ascii=False, default=default)
+
+def _std_dumps(obj):
+    return _std_encoder.encode(obj).encode('utf-8')
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+def set_backend(name):
+    ' 选择json实现：orjson或者json(标准库)，默认有orjson时用orjson '
+    global dumps, backend
+    if name == 'orjson':
+        if orjson is None:
+            raise RuntimeError('orjson is not installed, please pip install orjson')
+        dumps = _orjson_dumps
+    elif name == 'json':
+        dumps = _std_dumps
+    else:
+        raise ValueError('Unknown json backend: %s' % name)
+    backend = name
+    logging.info('json backend: %s' % name)
+
+backend = 'orjson' if orjson is not None else 'json'
+# dumps(obj) -> bytes
+dumps = _orjson_dumps if orjson is not None else _std_dumps
@@ -13,44 +13,48 @@ Models for user, blog, comment
 
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, Index
 
 def next_id():
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = dict(maxsize=10000, ttl=60)  # 博客页面反复查询作者，打开find缓存
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 class Blog(Model):
     __table__ = 'blogs'
+    __count_cache__ = dict(maxsize=1000, ttl=30)  # 分页需要的count缓存起来
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)', index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext', deferred=True)  # 内容很大，列表页不需要，用load_deferred()加载
+    created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = [Index('blog_id', 'created_at')]  # 按blog查询评论，按时间排序
+    __count_cache__ = dict(maxsize=1000, ttl=30)  # 分页需要的count缓存起来
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext', deferred=True)  # 内容很大，列表页不需要，用load_deferred()加载
+    created_at = FloatField(default=time.time, index=True)
 
 """
 SQL生成Models脚本
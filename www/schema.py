@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 31 14:40:37 2018
+
+@author: keen_liu
+"""
+
+
+'''
+根据Model生成建表DDL，并且和数据库里现有的表结构比较
+
+Models_init_schema.sql是手写的，很容易和models.py对不上(比如漏掉了comments.blog_id上的索引)，
+这里直接从ModelMetaclass生成的__mappings__和__index_list__生成DDL：
+
+python schema.py            打印所有Model的建表语句(MySQL)
+python schema.py sqlite     打印SQLite的建表语句
+python schema.py diff       连接配置里的数据库，打印需要执行的DDL(缺少的表、列和索引)
+
+代码里：
+await schema.create_tables([User, Blog, Comment])    # 例如在SQLite上跑测试之前建表
+statements = await schema.diff_schema([User, Blog, Comment])
+'''
+
+import asyncio, logging, re, sys
+
+import orm
+
+
+# MySQL的information_schema里的类型写法和DDL里的不一样：boolean => tinyint(1)，real => double，int(11) => int
+_TYPE_ALIASES = {'boolean': 'tinyint(1)', 'bool': 'tinyint(1)', 'real': 'double', 'integer': 'int'}
+_RE_INT_WIDTH = re.compile(r'^(tinyint|smallint|mediumint|int|bigint)\(\d+\)')
+
+def normalize_type(column_type, dialect='mysql'):
+    ' 归一化列类型，用来比较Model声明的类型和数据库里的类型 '
+    t = ' '.join(column_type.lower().split())
+    if dialect != 'mysql':
+        return t
+    t = _TYPE_ALIASES.get(t, t)
+    return t if t == 'tinyint(1)' else _RE_INT_WIDTH.sub(r'\1', t)
+
+def column_sql(model, name, dialect='mysql', not_null=True):
+    field = model.__mappings__[name]
+    return '`%s` %s%s' % (field.name or name, field.column_type, ' not null' if not_null else '')
+
+def index_name(model, idx, dialect='mysql'):
+    # sqlite的索引名在整个库里是唯一的，加上表名
+    return idx.name if dialect == 'mysql' else '%s_%s' % (model.__table__, idx.name)
+
+def index_sql(model, idx, dialect='mysql'):
+    return 'create %sindex `%s` on `%s` (%s);' % ('unique ' if idx.unique else '', index_name(model, idx, dialect), model.__table__, ', '.join(map(lambda c: '`%s`' % c, idx.columns)))
+
+def create_table_sql(model, dialect='mysql'):
+    ' 生成一个Model的建表语句，MySQL的索引写在建表语句里(和Models_init_schema.sql一样)，SQLite单独create index '
+    lines = [column_sql(model, f, dialect) for f in [model.__primary_key__] + model.__fields__]
+    if dialect == 'mysql':
+        for idx in model.__index_list__:
+            lines.append('%skey `%s` (%s)' % ('unique ' if idx.unique else '', idx.name, ', '.join(map(lambda c: '`%s`' % c, idx.columns))))
+    lines.append('primary key (`%s`)' % model.__primary_key__)
+    sql = 'create table `%s` (\n    %s\n)' % (model.__table__, ',\n    '.join(lines))
+    if dialect == 'mysql':
+        return sql + ' engine=innodb default charset=utf8;'
+    return '\n'.join([sql + ';'] + [index_sql(model, idx, dialect) for idx in model.__index_list__])
+
+def schema_sql(models, dialect='mysql'):
+    return '\n\n'.join(create_table_sql(m, dialect) for m in models)
+
+
+async def create_tables(models):
+    ' 在当前连接的数据库里创建所有的表和索引 '
+    dialect = orm.get_driver().name
+    for m in models:
+        for sql in create_table_sql(m, dialect).split(';'):
+            if sql.strip():
+                await orm.execute(orm.to_driver_sql(sql.strip()), [])
+
+async def diff_schema(models):
+    '''
+    比较Model和数据库里现有的表，返回需要执行的DDL语句列表：
+    不存在的表、缺少的列、类型不一致的列(MySQL生成modify column，SQLite不能修改列类型，只打印警告)、
+    缺少的索引(按索引的列和是否唯一比较，不比较索引名)。
+    数据库里多出来的索引只打印警告，不会生成drop语句。
+    '''
+    driver = orm.get_driver()
+    dialect = driver.name
+    statements = []
+    for m in models:
+        columns = await orm.select(driver.columns_sql, [m.__table__])
+        if not columns:
+            statements.append(create_table_sql(m, dialect))
+            continue
+        existing = dict((r['name'], r['column_type']) for r in columns)
+        for f in [m.__primary_key__] + m.__fields__:
+            name = m.__mappings__[f].name or f
+            if name not in existing:
+                # sqlite不能add column一个没有默认值的not null列
+                statements.append('alter table `%s` add column %s;' % (m.__table__, column_sql(m, f, dialect, dialect == 'mysql')))
+            elif normalize_type(existing[name], dialect) != normalize_type(m.__mappings__[f].column_type, dialect):
+                if dialect == 'mysql':
+                    statements.append('alter table `%s` modify column %s;' % (m.__table__, column_sql(m, f, dialect)))
+                else:
+                    logging.warning('column %s.%s is %s in database but %s in model %s' % (m.__table__, name, existing[name], m.__mappings__[f].column_type, m.__name__))
+        live = dict()
+        for r in await orm.select(driver.indexes_sql, [m.__table__]):
+            cols, unique = live.get(r['name'], ((), True))
+            live[r['name']] = (cols + (r['col'],), not r['non_unique'])
+        live_keys = set(live.values())
+        declared = set()
+        for idx in m.__index_list__:
+            declared.add((idx.columns, idx.unique))
+            if (idx.columns, idx.unique) not in live_keys:
+                statements.append(index_sql(m, idx, dialect))
+        for name, key in live.items():
+            if key not in declared:
+                logging.warning('index %s on %s(%s) is not declared in model %s' % (name, m.__table__, ', '.join(key[0]), m.__name__))
+    return statements
+
+
+if __name__ == '__main__':
+    from models import User, Blog, Comment
+    models = [User, Blog, Comment]
+    if len(sys.argv) > 1 and sys.argv[1] == 'diff':
+        from config import configs
+
+        async def diff():
+            db = configs.db
+            await orm.create_pool(None, host=db.host, port=db.port, user=db.user, password=db.password, db=db.database)
+            for sql in await diff_schema(models):
+                print(sql)
+            await orm.destroy_pool()
+
+        asyncio.get_event_loop().run_until_complete(diff())
+    else:
+        print(schema_sql(models, sys.argv[1] if len(sys.argv) > 1 else 'mysql'))